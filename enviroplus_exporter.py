@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 from glob import glob
 import os
+import errno
 import random
 import requests
 import time
 import logging
 import argparse
-import subprocess
-from threading import Thread
-from math import log10
+from threading import Thread, Lock, Event
+from collections import deque
+from bisect import bisect_left
+from array import array
 
 import ioexpander as io
 
-from prometheus_client import start_http_server, Gauge, Histogram
+from prometheus_client import start_http_server, Gauge, REGISTRY
+from prometheus_client.core import HistogramMetricFamily
+from prometheus_client.utils import floatToGoString
 
 from bme280 import BME280
 from enviroplus import gas
@@ -32,39 +36,47 @@ except ImportError:
     import ltr559
 
 
-o2Active = True
-co2Active = True
-tempActive = True
-pressActive = True
-humActive = True
-gasActive = True
-partActive = True
-lightActive = True
-
 MAXCOUNT = 2
 MINCOUNT = 0
 DEFAULT_READING = 0
 
-o2Count = MINCOUNT
-co2Count = MINCOUNT
-tempCount = MINCOUNT
-pressCount = MINCOUNT
-humCount = MINCOUNT
-gasCount = MINCOUNT
-partCount = MINCOUNT
-lightCount = MINCOUNT
 
+class SensorState:
+    """Whether a sensor is being read. A sensor is switched off after
+    MAXCOUNT failed readings and read again once it has been skipped
+    the same number of times"""
+    __slots__ = ('active', 'count')
+
+    def __init__(self):
+        self.active = True
+        self.count = MINCOUNT
+
+    def disable(self):
+        self.active = False
+        self.count = MAXCOUNT
+
+    def trip(self):
+        self.count += 1
+        if self.count >= MAXCOUNT:
+            self.disable()
+
+    def recover(self):
+        if self.count > MINCOUNT:
+            self.count -= 1
+        else:
+            self.count = MINCOUNT
+            self.active = True
+
+
+o2_state = SensorState()
+co2_state = SensorState()
+temp_state = SensorState()
+press_state = SensorState()
+hum_state = SensorState()
+gas_state = SensorState()
+part_state = SensorState()
+light_state = SensorState()
 
-try:
-    # setting up IOexpander
-    ioe = io.IOE(i2c_addr=0x18)
-    o2_pin = 12
-    ioe.set_adc_vref(5.0)  # Input voltage of IO Expander, this is 3.3 on Breakout Garden
-    ioe.set_mode(o2_pin, io.ADC)
-except:
-    o2Active = False
-    o2Count = MAXCOUNT
-    logging.error("O2 sensor cannot be initialised")
 
 logging.basicConfig(
     format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s',
@@ -79,23 +91,39 @@ Press Ctrl+C to exit!
 
 """)
 
-DEBUG = os.getenv('DEBUG', 'false') == 'true'
+_log = logging.getLogger(__name__)
+
+try:
+    # setting up IOexpander
+    ioe = io.IOE(i2c_addr=0x18)
+    o2_pin = 12
+    ioe.set_adc_vref(5.0)  # Input voltage of IO Expander, this is 3.3 on Breakout Garden
+    ioe.set_mode(o2_pin, io.ADC)
+except Exception as e:
+    ioe = None
+    o2_state.disable()
+    logging.error("O2 sensor cannot be initialised: {!r}".format(e))
 
 bus = SMBus(1)
+# Serialises transfers on i2c bus 1 between the poller threads. BME280 uses
+# this bus handle; the gas ADC and LTR559 open their own handles to the bus
+_i2c1_lock = Lock()
 
 try:
     bme280 = BME280(i2c_dev=bus)
-except:
-    tempActive, pressActive, humActive = False
-    tempCount, pressCount, humCount = MAXCOUNT
-    logging.error('Temperature, Pressure, Humidity sensors not present or inactive')
+except Exception as e:
+    bme280 = None
+    temp_state.disable()
+    press_state.disable()
+    hum_state.disable()
+    logging.error('Temperature, Pressure, Humidity sensors not present or inactive: {!r}'.format(e))
     
 try:
     pms5003 = PMS5003()
-except:
-    partActive = False
-    partCount = MAXCOUNT
-    logging.error('Particulate sensors not present or inactive')
+except Exception as e:
+    pms5003 = None
+    part_state.disable()
+    logging.error('Particulate sensors not present or inactive: {!r}'.format(e))
 
 #unit 1 gas base readings
 _base_ox = 108706
@@ -107,186 +135,273 @@ _ox_factor = 0.01
 _red_factor = 2.0
 _nh3_factor = 1.7
 
-TEMPERATURE = Gauge('temperature','Temperature measured (*C)')
-PRESSURE = Gauge('pressure','Pressure measured (hPa)')
-HUMIDITY = Gauge('humidity','Relative humidity measured (%)')
-OXIDISING = Gauge('oxidising','Mostly nitrogen dioxide but could include NO and Hydrogen (Ohms)')
-REDUCING = Gauge('reducing', 'Mostly carbon monoxide but could include H2S, Ammonia, Ethanol, Hydrogen, Methane, Propane, Iso-butane (Ohms)')
-NH3 = Gauge('NH3', 'mostly Ammonia but could also include Hydrogen, Ethanol, Propane, Iso-butane (Ohms)')
-CO2 = Gauge('CO2', 'CO2 measured (PPM)')
-O2 = Gauge('O2', 'O2 measured (%)')
-LUX = Gauge('lux', 'current ambient light level (lux)')
-PROXIMITY = Gauge('proximity', 'proximity, with larger numbers being closer proximity and vice versa')
-PM1 = Gauge('PM1', 'Particulate Matter of diameter less than 1 micron. Measured in micrograms per cubic metre (ug/m3)')
-PM25 = Gauge('PM25', 'Particulate Matter of diameter less than 2.5 microns. Measured in micrograms per cubic metre (ug/m3)')
-PM10 = Gauge('PM10', 'Particulate Matter of diameter less than 10 microns. Measured in micrograms per cubic metre (ug/m3)')
-
-OXIDISING_HIST = Histogram('oxidising_measurements', 'Histogram of oxidising measurements', buckets=(0, 10000, 15000, 20000, 25000, 30000, 35000, 40000, 45000, 50000, 55000, 60000, 65000, 70000, 75000, 80000, 85000, 90000, 100000))
-REDUCING_HIST = Histogram('reducing_measurements', 'Histogram of reducing measurements', buckets=(0, 100000, 200000, 300000, 400000, 500000, 600000, 700000, 800000, 900000, 1000000, 1100000, 1200000, 1300000, 1400000, 1500000))
-NH3_HIST = Histogram('nh3_measurements', 'Histogram of nh3 measurements', buckets=(0, 10000, 110000, 210000, 310000, 410000, 510000, 610000, 710000, 810000, 910000, 1010000, 1110000, 1210000, 1310000, 1410000, 1510000, 1610000, 1710000, 1810000, 1910000, 2000000))
-CO2_HIST = Histogram('co2_measurements', 'Histogram of co2 measurements', buckets=(0, 500, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 5000, 5500, 6000, 6500, 7000, 7500, 8000, 8500, 9000, 9500, 10000))
-O2_HIST = Histogram('o2_measurements', 'Histogram of o2 measurements', buckets=(0, 2, 4, 6, 8, 10, 12, 16, 18, 20, 22, 24, 26))
-
-PM1_HIST = Histogram('pm1_measurements', 'Histogram of Particulate Matter of diameter less than 1 micron measurements', buckets=(0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100))
-PM25_HIST = Histogram('pm25_measurements', 'Histogram of Particulate Matter of diameter less than 2.5 micron measurements', buckets=(0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100))
-PM10_HIST = Histogram('pm10_measurements', 'Histogram of Particulate Matter of diameter less than 10 micron measurements', buckets=(0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100))
-
-
-# Sometimes the sensors can't be read. Resetting the i2c 
+class TrackedGauge:
+    """A Gauge whose value is the last reading set. The reading is stored as a
+    plain attribute and pulled by the Gauge at scrape time, so pollers and
+    scrapes never contend on the Gauge's lock"""
+    __slots__ = ('gauge', 'last')
+
+    def __init__(self, name, documentation):
+        self.gauge = Gauge(name, documentation)
+        self.last = 0.0
+        self.gauge.set_function(lambda: self.last)
+
+    def set(self, value):
+        self.last = value
+
+
+TEMPERATURE = TrackedGauge('temperature','Temperature measured (*C)')
+PRESSURE = TrackedGauge('pressure','Pressure measured (hPa)')
+HUMIDITY = TrackedGauge('humidity','Relative humidity measured (%)')
+OXIDISING = TrackedGauge('oxidising','Mostly nitrogen dioxide but could include NO and Hydrogen (Ohms)')
+REDUCING = TrackedGauge('reducing', 'Mostly carbon monoxide but could include H2S, Ammonia, Ethanol, Hydrogen, Methane, Propane, Iso-butane (Ohms)')
+NH3 = TrackedGauge('NH3', 'mostly Ammonia but could also include Hydrogen, Ethanol, Propane, Iso-butane (Ohms)')
+CO2 = TrackedGauge('CO2', 'CO2 measured (PPM)')
+O2 = TrackedGauge('O2', 'O2 measured (%)')
+LUX = TrackedGauge('lux', 'current ambient light level (lux)')
+PROXIMITY = TrackedGauge('proximity', 'proximity, with larger numbers being closer proximity and vice versa')
+PM1 = TrackedGauge('PM1', 'Particulate Matter of diameter less than 1 micron. Measured in micrograms per cubic metre (ug/m3)')
+PM25 = TrackedGauge('PM25', 'Particulate Matter of diameter less than 2.5 microns. Measured in micrograms per cubic metre (ug/m3)')
+PM10 = TrackedGauge('PM10', 'Particulate Matter of diameter less than 10 microns. Measured in micrograms per cubic metre (ug/m3)')
+
+class FastHist:
+    """A Histogram that finds the bucket for an observation with a binary
+    search over its bounds, exposed to Prometheus as a custom collector"""
+    __slots__ = ('name', 'documentation', 'bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        # Sorted upper bounds as a flat array('d'), may be shared between histograms
+        self.bounds = buckets
+        # The extra slot is the +Inf bucket
+        self.counts = array('Q', [0] * (len(self.bounds) + 1))
+        self.sum = 0.0
+        self.lock = Lock()
+        REGISTRY.register(self)
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.sum += value
+
+    def collect(self):
+        with self.lock:
+            counts = self.counts.tolist()
+            total = self.sum
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            buckets.append((floatToGoString(bound), cumulative))
+        buckets.append(('+Inf', cumulative + counts[-1]))
+        yield HistogramMetricFamily(self.name, self.documentation, buckets=buckets, sum_value=total)
+
+
+TRACKED = {
+    'temperature': TEMPERATURE,
+    'humidity': HUMIDITY,
+    'pressure': PRESSURE,
+    'oxidising': OXIDISING,
+    'reducing': REDUCING,
+    'nh3': NH3,
+    'lux': LUX,
+    'proximity': PROXIMITY,
+    'pm1': PM1,
+    'pm25': PM25,
+    'pm10': PM10,
+    'o2': O2,
+    'co2': CO2,
+}
+
+# Histogram bucket bounds
+_BUCKETS_OXIDISING = array('d', (0, 10000, 15000, 20000, 25000, 30000, 35000, 40000, 45000, 50000, 55000, 60000, 65000, 70000, 75000, 80000, 85000, 90000, 100000))
+_BUCKETS_REDUCING = array('d', (0, 100000, 200000, 300000, 400000, 500000, 600000, 700000, 800000, 900000, 1000000, 1100000, 1200000, 1300000, 1400000, 1500000))
+_BUCKETS_NH3 = array('d', (0, 10000, 110000, 210000, 310000, 410000, 510000, 610000, 710000, 810000, 910000, 1010000, 1110000, 1210000, 1310000, 1410000, 1510000, 1610000, 1710000, 1810000, 1910000, 2000000))
+_BUCKETS_CO2 = array('d', (0, 500, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 5000, 5500, 6000, 6500, 7000, 7500, 8000, 8500, 9000, 9500, 10000))
+_BUCKETS_O2 = array('d', (0, 2, 4, 6, 8, 10, 12, 16, 18, 20, 22, 24, 26))
+_BUCKETS_PM = array('d', (0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100))
+
+OXIDISING_HIST = FastHist('oxidising_measurements', 'Histogram of oxidising measurements', buckets=_BUCKETS_OXIDISING)
+REDUCING_HIST = FastHist('reducing_measurements', 'Histogram of reducing measurements', buckets=_BUCKETS_REDUCING)
+NH3_HIST = FastHist('nh3_measurements', 'Histogram of nh3 measurements', buckets=_BUCKETS_NH3)
+CO2_HIST = FastHist('co2_measurements', 'Histogram of co2 measurements', buckets=_BUCKETS_CO2)
+O2_HIST = FastHist('o2_measurements', 'Histogram of o2 measurements', buckets=_BUCKETS_O2)
+
+PM1_HIST = FastHist('pm1_measurements', 'Histogram of Particulate Matter of diameter less than 1 micron measurements', buckets=_BUCKETS_PM)
+PM25_HIST = FastHist('pm25_measurements', 'Histogram of Particulate Matter of diameter less than 2.5 micron measurements', buckets=_BUCKETS_PM)
+PM10_HIST = FastHist('pm10_measurements', 'Histogram of Particulate Matter of diameter less than 10 micron measurements', buckets=_BUCKETS_PM)
+
+
+# The SCD4x is initialised from a background thread at startup
+device = None
+_scd4x_ready = Event()
+
+CPU_TEMP_PATH = "/sys/class/thermal/thermal_zone0/temp"
+_thermal_fd = None
+
+# Latest PMS5003 frame handed from the reader thread to the poller, None when
+# the read failed. deque append and popleft are atomic so no lock is needed
+_pms_frames = deque(maxlen=1)
+
+# Rolling window of CPU temperatures used to smooth the compensation
+_cpu_temp_hist = deque(maxlen=5)
+_cpu_avg = 0.0
+
+
+# Sometimes the BME280 can't be read. Reopening its bus handle resets the i2c
 def reset_i2c():
-    subprocess.run(['i2cdetect', '-y', '1'])
-    time.sleep(2)
+    with _i2c1_lock:
+        bus.close()
+        bus.open(1)
+
 
+def _retry(fn, max_retries=3, base=0.25, cap=4.0, reset=None):
+    """Call fn, retrying bus errors with exponential backoff and jitter.
+    After max_retries consecutive failures reset is called and the error raised"""
+    for attempt in range(max_retries):
+        try:
+            return fn()
+        except (IOError, OSError):
+            if attempt == max_retries - 1:
+                if reset:
+                    reset()
+                raise
+            time.sleep(min(cap, base * 2 ** attempt) * (1 + random.random() * 0.5))
+
+
+def _read_i2c(fn, reset=None):
+    """Read from a sensor on i2c bus 1, serialised with the other sensors"""
+    def locked_read():
+        with _i2c1_lock:
+            return fn()
+    return _retry(locked_read, reset=reset)
 
-# Get the temperature of the CPU for compensation
+
+# Get the temperature of the CPU for compensation. The sysfs file is kept
+# open and re-read from the start on every call
 def get_cpu_temperature():
-    with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
-        temp = f.read()
-        temp = int(temp) / 1000.0
-    return temp
+    global _thermal_fd
+    if _thermal_fd is None:
+        _thermal_fd = os.open(CPU_TEMP_PATH, os.O_RDONLY)
+    try:
+        temp = os.pread(_thermal_fd, 16, 0)
+    except OSError as e:
+        if e.errno != errno.EBADF:
+            raise
+        _thermal_fd = os.open(CPU_TEMP_PATH, os.O_RDONLY)
+        temp = os.pread(_thermal_fd, 16, 0)
+    return int(temp) / 1000.0
 
 
 def get_temperature(factor):
     """Get temperature from the weather sensor"""
     # Tuning factor for compensation. Decrease this number to adjust the
     # temperature down, and increase to adjust up
-    global tempActive
-    global tempCount
-    if tempActive:
+    global _cpu_avg
+    # Nothing to read if the sensor could not be initialised
+    if bme280 is None:
+        return
+
+    if temp_state.active:
         try:
-            raw_temp = bme280.get_temperature()
+            raw_temp = _read_i2c(bme280.get_temperature, reset=reset_i2c)
         except (IOError, RuntimeError, OSError, ValueError):
             logging.error("Could not get temperature readings. Resetting i2c")
-            reset_i2c()
             TEMPERATURE.set(0)
-            tempCount += 1
-            
-            if tempCount >= MAXCOUNT:
-                tempCount = MAXCOUNT
-                tempActive = False
+            temp_state.trip()
+            return
 
         if factor:
-            cpu_temps = [get_cpu_temperature()] * 5
-            cpu_temp = get_cpu_temperature()
             # Smooth out with some averaging to decrease jitter
-            cpu_temps = cpu_temps[1:] + [cpu_temp]
-            avg_cpu_temp = sum(cpu_temps) / float(len(cpu_temps))
-            temperature = raw_temp - ((avg_cpu_temp - raw_temp) / factor)
+            cpu_temp = get_cpu_temperature()
+            if not _cpu_temp_hist:
+                _cpu_temp_hist.extend([cpu_temp] * _cpu_temp_hist.maxlen)
+                _cpu_avg = cpu_temp
+            # Update the running average with the sample that drops out of the window
+            oldest = _cpu_temp_hist[0]
+            _cpu_temp_hist.append(cpu_temp)
+            _cpu_avg += (cpu_temp - oldest) / _cpu_temp_hist.maxlen
+            temperature = raw_temp - ((_cpu_avg - raw_temp) / factor)
         else:
             temperature = raw_temp
 
         TEMPERATURE.set(temperature)   # Set to a given value
     else:
         TEMPERATURE.set(0)
-        tempCount += 1
         logging.error("Temperature sensor not present or inactive")
-        
-        if tempCount > MINCOUNT:
-            tempCount -= 1
-        else:
-            tempCount = MINCOUNT
-            tempActive = True
+        temp_state.recover()
 
 def get_pressure():
     """Get pressure from the weather sensor"""
-    global pressActive
-    global pressCount
-    if pressActive:
+    # Nothing to read if the sensor could not be initialised
+    if bme280 is None:
+        return
+
+    if press_state.active:
         try:
-            pressure = bme280.get_pressure()
+            pressure = _read_i2c(bme280.get_pressure, reset=reset_i2c)
             PRESSURE.set(pressure)
         except (IOError, RuntimeError, OSError, ValueError):
             logging.error("Could not get pressure readings. Resetting i2c.")
-            reset_i2c()
             PRESSURE.set(0)
-            pressCount += 1
-            
-            if pressCount >= MAXCOUNT:
-                pressCount = MAXCOUNT
-                pressActive = False
+            press_state.trip()
     else:
         PRESSURE.set(0)
         logging.error("Pressure sensor not present or inactive")
-
-        if pressCount > MINCOUNT:
-            pressCount -= 1
-        else:
-            pressCount = MINCOUNT
-            pressActive = True
+        press_state.recover()
 
 
 def get_humidity():
     """Get humidity from the weather sensor"""
-    global humActive
-    global humCount
-    if humActive:
+    # Nothing to read if the sensor could not be initialised
+    if bme280 is None:
+        return
+
+    if hum_state.active:
         try:
-            humidity = bme280.get_humidity()
+            humidity = _read_i2c(bme280.get_humidity, reset=reset_i2c)
             HUMIDITY.set(humidity)
         except (IOError, RuntimeError, OSError, ValueError):
             logging.error("Could not get humidity readings. Resetting i2c.")
-            reset_i2c()
             HUMIDITY.set(0)
-
-            humCount += 1
-
-            if humCount >= MAXCOUNT:
-                humCount = MAXCOUNT
-                humActive = False
+            hum_state.trip()
     else:
         HUMIDITY.set(0)
         logging.error("Humidity sensor not present or inactive")
-
-        if humCount > MINCOUNT:
-            humCount -= 1
-        else:
-            humCount = MINCOUNT
-            humActive = True
+        hum_state.recover()
 
 def calc_ppm(ox, red, nh3):
-    global _base_ox
-    global _base_red
-    global _base_nh3
-    global _ox_factor
-    global _red_factor
-    global _nh3_factor
-    
-    try: # N02 PPM
-        oxidising = round(((ox/_base_ox) * _ox_factor),2)
-    except ZeroDivisionError:
-        oxidising = 0.0
-        
-    try: # CO PPM
-        reducing = round((10**(log10(red/_base_red)) * _red_factor),2)
-    except ZeroDivisionError:
-        reducing = 0.0
-
-    try: # NH3 PPM
-        ammonia = round((10**(log10(nh3/_base_nh3)) * _nh3_factor),2)
-    except ZeroDivisionError:
-        ammonia = 0.0
+    # N02 PPM
+    oxidising = round(((ox/_base_ox) * _ox_factor),2) if _base_ox else 0.0
+    # CO PPM
+    reducing = round(((red/_base_red) * _red_factor),2) if _base_red else 0.0
+    # NH3 PPM
+    ammonia = round(((nh3/_base_nh3) * _nh3_factor),2) if _base_nh3 else 0.0
 
     return oxidising, reducing, ammonia
 
+def init_gas():
+    """Check the gas sensor responds"""
+    try:
+        gas.read_all()
+    except Exception as e:
+        gas_state.disable()
+        logging.error('Gas sensors not present or inactive: {!r}'.format(e))
+
+
 def get_gas():
     """Get all gas readings"""
-    global gasActive
-    global gasCount
-    global MAXCOUNT
-    global MINCOUNT
-    
-    if gasActive:
+    if gas_state.active:
         try:
-            gas.enable_adc()
-            readings = gas.read_all()
+            readings = _read_i2c(gas.read_all)
             ox = readings.oxidising
             red = readings.reducing
             nh3 = readings.nh3
             ppm = calc_ppm(ox, red, nh3)
             
         except (IOError, RuntimeError, OSError, ValueError):
-            logging.error("Could not get gas reading. Resetting i2c.")
-            reset_i2c()
+            logging.error("Could not get gas reading.")
             
             OXIDISING.set(0)
             OXIDISING_HIST.observe(0)
@@ -297,11 +412,7 @@ def get_gas():
             NH3.set(0)
             NH3_HIST.observe(0)
 
-            gasCount += 1
-
-            if gasCount >= MAXCOUNT:
-                gasCount = MAXCOUNT
-                gasActive = False
+            gas_state.trip()
         else:
             OXIDISING.set(ppm[0])
             OXIDISING_HIST.observe(ppm[0])
@@ -321,124 +432,125 @@ def get_gas():
         NH3.set(0)
         NH3_HIST.observe(0)
         logging.error("GAS sensor not present or inactive")
-
-        if gasCount > MINCOUNT:
-            gasCount -= 1
-        else:
-            gasCount = MINCOUNT
-            gasActive = True
+        gas_state.recover()
 
 
 def get_o2():
     """Get O2 reading via ioexpander"""
-    global o2Active
-    global o2Count
+    # Nothing to read if the sensor could not be initialised
+    if ioe is None:
+        return
 
-    if o2Active:
+    if o2_state.active:
         try:
-            adc = ioe.input(o2_pin)
+            adc = _retry(lambda: ioe.input(o2_pin))
             adc = round(adc,2)     
         except (IOError, RuntimeError, OSError, ValueError):
-            logging.error("Could not get o2 reading. Resetting i2c.")
-            reset_i2c()
-            o2Count += 1
+            logging.error("Could not get o2 reading.")
             O2.set(0)
             O2_HIST.observe(0)
-
-            if o2Count >= MAXCOUNT:
-                o2Count = MAXCOUNT
-                o2Active = False
+            o2_state.trip()
         else:
-            O2.set(((adc*0.212)/2.0)*100)
-            O2_HIST.observe(((adc*0.212)/2.0)*100)
+            # ((adc * 0.212) / 2.0) * 100
+            o2 = adc * 10.6
+            O2.set(o2)
+            O2_HIST.observe(o2)
     else:
         O2.set(0)
         O2_HIST.observe(0)
         logging.error("O2 sensor not present or inactive")
+        o2_state.recover()
 
-        if o2Count > MINCOUNT:
-            o2Count -= 1
-        else:
-            o2Count = MINCOUNT
-            o2Active = True
+
+def init_scd4x():
+    """Start periodic measurement on the SCD4x CO2 sensor"""
+    global device
+    try:
+        device = SCD4X(quiet=False)
+        device.start_periodic_measurement()
+    except Exception as e:
+        co2_state.disable()
+        logging.error("CO2 sensor cannot be initialised: {!r}".format(e))
+    else:
+        _scd4x_ready.set()
 
 
 def get_co2():
     """Get CO2 readings plus additional sensor readings"""
-    global co2Active
-    global co2Count
+    # Nothing to read until the sensor has been initialised
+    if not _scd4x_ready.is_set():
+        return
 
-    if co2Active: 
+    if co2_state.active: 
         try:
-            co2, temperature, relative_humidity, timestamp = device.measure()
+            # Returns None straight away if no new measurement is ready
+            measurement = _retry(lambda: device.measure(blocking=False))
         except (IOError, RuntimeError, OSError, ValueError):
-            logging.error("Could not get CO2 reading. Resetting i2c.")
-            reset_i2c()
-            co2Count += 1
+            logging.error("Could not get CO2 reading.")
             CO2.set(0)
             CO2_HIST.observe(0)
-
-            if co2Count >= MAXCOUNT:
-                co2Count = MAXCOUNT
-                co2Active = False
+            co2_state.trip()
         else:
+            if measurement is None:
+                # Keep the previous reading until the next one is ready
+                return
+            co2, temperature, relative_humidity, timestamp = measurement
             CO2.set(co2)
             CO2_HIST.observe(co2)
     else:
         CO2.set(0)
         CO2_HIST.observe(0)
         logging.error("CO2 sensor not present or inactive")
-
-        if co2Count > MINCOUNT:
-            co2Count -= 1
-        else:
-            co2Count = MINCOUNT
-            co2Active = True
+        co2_state.recover()
 
 
 def get_light():
     """Get all light readings"""
-    global lightActive
-    global lightCount
-
-    if lightActive:
+    if light_state.active:
         try:
-           lux = ltr559.get_lux()
-           prox = ltr559.get_proximity()
+            lux = _read_i2c(ltr559.get_lux)
+            prox = _read_i2c(ltr559.get_proximity)
 
-           LUX.set(lux)
-           PROXIMITY.set(prox)
+            LUX.set(lux)
+            PROXIMITY.set(prox)
         except (IOError, RuntimeError, OSError, ValueError):
-            logging.error("Could not get lux and proximity readings. Resetting i2c.")
-            reset_i2c()
+            logging.error("Could not get lux and proximity readings.")
             LUX.set(0)
             PROXIMITY.set(0)
-
-            lightCount += 1
-
-            if lightCount >= MAXCOUNT:
-                lightCount = MAXCOUNT
-                lightActive = False
+            light_state.trip()
     else:
         LUX.set(0)
         PROXIMITY.set(0)
         logging.error("Light and Proximity sensors not present or inactive")
+        light_state.recover()
 
-        if lightCount > MINCOUNT:
-            lightCount -= 1
-        else:
-            lightCount = MINCOUNT
-            lightActive = True
+
+def read_pms5003():
+    """Read PMS5003 frames forever. read() blocks until the next frame
+    arrives on the UART, so this runs on its own thread"""
+    while True:
+        try:
+            _pms_frames.append(pms5003.read())
+        except (IOError, pmsReadTimeoutError, pmsChecksumError, pmsSerialTimoutError, RuntimeError, OSError, ValueError):
+            _pms_frames.append(None)
+            time.sleep(1)
+        except Exception:
+            # Keep reading so the poller sees the failure instead of a stale frame
+            logging.exception("Unexpected error reading PMS5003")
+            _pms_frames.append(None)
+            time.sleep(1)
 
 
 def get_particulates():
-    """Get the particulate matter readings"""
-    global partActive
-    global partCount
-    if partActive:
+    """Get the particulate matter readings from the latest PMS5003 frame"""
+    if part_state.active:
         try:
-            pms_data = pms5003.read()
-        except (IOError, pmsReadTimeoutError, pmsChecksumError, pmsSerialTimoutError, RuntimeError, OSError, ValueError):
+            pms_data = _pms_frames.popleft()
+        except IndexError:
+            # No new frame since the last poll, keep the previous readings
+            return
+
+        if pms_data is None:
             logging.error("Could not get particulate matter readings.")
             PM1.set(0)
             PM25.set(0)
@@ -446,20 +558,19 @@ def get_particulates():
             PM1_HIST.observe(0)
             PM25_HIST.observe(0)
             PM10_HIST.observe(0)
-            
-            partCount += 1
-
-            if partCount >= MAXCOUNT:
-                partCount = MAXCOUNT
-                partActive = False
+            part_state.trip()
         else:
-            PM1.set(pms_data.pm_ug_per_m3(1.0))
-            PM25.set(pms_data.pm_ug_per_m3(2.5))
-            PM10.set(pms_data.pm_ug_per_m3(10))
+            pm1 = pms_data.pm_ug_per_m3(1.0)
+            pm25 = pms_data.pm_ug_per_m3(2.5)
+            pm10 = pms_data.pm_ug_per_m3(10)
+
+            PM1.set(pm1)
+            PM25.set(pm25)
+            PM10.set(pm10)
 
-            PM1_HIST.observe(pms_data.pm_ug_per_m3(1.0))
-            PM25_HIST.observe(pms_data.pm_ug_per_m3(2.5) - pms_data.pm_ug_per_m3(1.0))
-            PM10_HIST.observe(pms_data.pm_ug_per_m3(10) - pms_data.pm_ug_per_m3(2.5))
+            PM1_HIST.observe(pm1)
+            PM25_HIST.observe(pm25 - pm1)
+            PM10_HIST.observe(pm10 - pm25)
     else:
         PM1.set(0)
         PM25.set(0)
@@ -469,31 +580,40 @@ def get_particulates():
         PM25_HIST.observe(0)
         PM10_HIST.observe(0)
         logging.error("Particulate sensors not present or inactive")
+        part_state.recover()
+
+
+def get_weather(factor):
+    """Get all readings from the BME280 weather sensor"""
+    get_temperature(factor)
+    get_pressure()
+    get_humidity()
 
-        if partCount > MINCOUNT:
-            partCount -= 1
-        else:
-            partCount = MINCOUNT
-            partActive = True
+
+def poll_sensor(read, interval, *args):
+    """Read a sensor forever at its own update rate, the gauges keep the
+    last value for Prometheus to scrape"""
+    # Readings are scheduled against fixed deadlines so the time spent
+    # reading does not make the cadence drift
+    next_due = time.monotonic()
+    while True:
+        try:
+            read(*args)
+        except Exception:
+            # Keep polling so one bad reading does not stop the sensor for good
+            logging.exception("Unexpected error reading sensor with {}".format(read.__name__))
+        next_due += interval
+        now = time.monotonic()
+        if next_due <= now:
+            # Overran (e.g. retrying a read), wait a full interval from now
+            # rather than reading back to back to catch up
+            next_due = now + interval
+        time.sleep(next_due - now)
 
 
 def collect_all_data():
     """Collects all the data currently set"""
-    sensor_data = {}
-    sensor_data['temperature'] = TEMPERATURE.collect()[0].samples[0].value
-    sensor_data['humidity'] = HUMIDITY.collect()[0].samples[0].value
-    sensor_data['pressure'] = PRESSURE.collect()[0].samples[0].value
-    sensor_data['oxidising'] = OXIDISING.collect()[0].samples[0].value
-    sensor_data['reducing'] = REDUCING.collect()[0].samples[0].value
-    sensor_data['nh3'] = NH3.collect()[0].samples[0].value
-    sensor_data['lux'] = LUX.collect()[0].samples[0].value
-    sensor_data['proximity'] = PROXIMITY.collect()[0].samples[0].value
-    sensor_data['pm1'] = PM1.collect()[0].samples[0].value
-    sensor_data['pm25'] = PM25.collect()[0].samples[0].value
-    sensor_data['pm10'] = PM10.collect()[0].samples[0].value
-    sensor_data['o2'] = O2.collect()[0].samples[0].value
-    sensor_data['co2'] = CO2.collect()[0].samples[0].value
-    return sensor_data
+    return {name: gauge.last for name, gauge in TRACKED.items()}
 
 
 def str_to_bool(value):
@@ -510,38 +630,47 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--port", metavar='PORT', default=8000, type=int, help="Specify alternate port [default: 8000]")
     parser.add_argument("-f", "--factor", metavar='FACTOR', type=float, help="The compensation factor to get better temperature results when the Enviro+ pHAT is too close to the Raspberry Pi board")
     parser.add_argument("-e", "--enviro", metavar='ENVIRO', type=str_to_bool, help="Device is an Enviro (not Enviro+) so don't fetch data from gas and particulate sensors as they don't exist")
-    parser.add_argument("-d", "--debug", metavar='DEBUG', type=str_to_bool, help="Turns on more verbose logging, showing sensor output and post responses [default: false]")
+    parser.add_argument("-l", "--log-level", metavar='LEVEL', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], type=str.upper, help="Logging level, DEBUG also logs the sensor output [default: INFO]")
     args = parser.parse_args()
 
+    logging.getLogger().setLevel(args.log_level)
+
+    # Enviro boards have no gas sensor
+    if not args.enviro:
+        init_gas()
+
+    # Enable CO2 sensor in the background so its warm-up overlaps with
+    # the server start
+    Thread(target=init_scd4x, daemon=True).start()
+
     # Start up the server to expose the metrics.
     start_http_server(addr=args.bind, port=args.port)
-    # Generate some requests.
-    
-    try:
-        # Enable CO2 sensor
-        device = SCD4X(quiet=False)
-        device.start_periodic_measurement()
-    except:
-        co2Active = False
-        logging.error("CO2 sensor cannot be initialised")
-
-    if args.debug:
-        DEBUG = True
 
     if args.factor:
         logging.info("Using compensating algorithm (factor={}) to account for heat leakage from Raspberry Pi board".format(args.factor))
 
     logging.info("Listening on http://{}:{}".format(args.bind, args.port))
 
-    while True:
-        get_temperature(args.factor)
-        get_pressure()
-        get_humidity()
-        get_light()
-        if not args.enviro:
-            get_gas()
-            get_o2()
-            get_particulates()
-            get_co2()
-        if DEBUG:
-            logging.info('Sensor data: {}'.format(collect_all_data()))
+    # Each sensor is polled on its own thread at roughly its native update
+    # rate (interval in seconds)
+    pollers = [
+        (get_weather, 1.0, (args.factor,)),
+        (get_light, 0.5, ()),
+    ]
+    if not args.enviro:
+        pollers += [
+            (get_gas, 1.0, ()),
+            (get_o2, 1.0, ()),
+            (get_particulates, 1.0, ()),
+            (get_co2, 5.0, ()),
+        ]
+        if pms5003 is not None:
+            Thread(target=read_pms5003, daemon=True).start()
+
+    for read, interval, read_args in pollers:
+        Thread(target=poll_sensor, args=(read, interval) + read_args, daemon=True).start()
+
+    stop = Event()
+    while not stop.wait(1):
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('Sensor data: %r', collect_all_data())